@@ -15,61 +15,299 @@
 
 """Multiprocessing pool providing a unique request session per process."""
 
+import asyncio
+import functools
+import inspect
 import itertools
 import multiprocessing
+import multiprocessing.pool
+import multiprocessing.util
 import os
+import sys
+import threading
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 __author__  = "miruka"
 __email__   = "miruka@disroot.org"
 __license__ = "LGPLv3"
 __version__ = "1.0.1"
 
+# Holds the state of the current worker thread or process: its special object
+# (session by default) as `session`, created once by _worker_init() when it
+# starts, and its event loop as `loop` once a coroutine function was run.
+_WORKER = threading.local()
 
-def _split_items(iterable, split_in):
-    """Split iterable sequence of items into even subsequences.
+
+def _new_session(pool_maxsize=32):
+    """Return a `requests.Session` tuned for many requests to few hosts.
 
     Args:
-        iterable:  Iterable sequence of element, like a list or tuple.
-        split_in (int): Number of even chunks to split the given sequence in.
+        pool_maxsize (int): Maximum number of connections kept alive per host.
 
     Returns:
-        (tuple, list): Defaults to tuple unless `iterable` was a list.
-            Tuple/list containing a tuple/list for each subsequence.
+        (requests.Session): Session with HTTP and HTTPS adapters mounted,
+            retrying failed connections twice with a short backoff.
+    """
+
+    session = requests.Session()
+
+    for prefix in ("https://", "http://"):
+        session.mount(prefix, HTTPAdapter(
+            pool_maxsize = pool_maxsize,
+            pool_block   = False,
+            max_retries  = Retry(total=2, backoff_factor=0.1),
+        ))
+
+    return session
+
+
+def _cpu_count():
+    """Return the number of CPUs the current process is allowed to use.
+
+    Unlike `os.cpu_count()`, respects the CPU affinity set by e.g. `taskset`
+    or a container's cpuset where the platform supports it.
+    """
+
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count()
+
+
+def _new_worker(special_func, special_args, special_kwargs,
+                user_init=None, user_initargs=()):
+    """Create a special object, then run the user initializer.
+
+    Returns:
+        (dict): Worker state, with the special object as `session`.
+    """
+
+    state = {"session": special_func(*special_args, **special_kwargs)}
+
+    if user_init is not None:
+        user_init(*user_initargs)
+
+    return state
+
+
+def _worker_init(special_func, special_args, special_kwargs,
+                 user_init=None, user_initargs=(), workers=None):
+    """Set the state of a new pool worker, see `_new_worker()`.
+
+    Ran once at the start of every pool worker, so that the session and its
+    kept-alive connections last for the worker's lifetime instead of being
+    recreated for each task.
+
+    Worker threads add their state to the `workers` list, for the pool to
+    close it once they are joined. Worker processes, whose `atexit`
+    handlers never run, close theirs with a multiprocessing finalizer
+    when they exit.
+    """
+
+    # A threading.local's __dict__ holds the attributes of the current thread.
+    _WORKER.__dict__.update(_new_worker(
+        special_func, special_args, special_kwargs, user_init, user_initargs
+    ))
+
+    if workers is None:
+        multiprocessing.util.Finalize(
+            None, _close_worker, (_WORKER.__dict__,), exitpriority=0
+        )
+    else:
+        workers.append(_WORKER.__dict__)
+
+
+def _close_worker(state):
+    """Close the special object and event loop of a worker's state dict.
+
+    Asynchronous clients like `httpx.AsyncClient` are closed in the event
+    loop they were used in; special objects without a `close()` method
+    are left alone.
+    """
+
+    session = state.get("session")
+    loop    = state.get("loop")
+
+    try:
+        if loop is not None and hasattr(session, "aclose"):
+            loop.run_until_complete(session.aclose())
+        elif hasattr(session, "close"):
+            session.close()
+    finally:
+        if loop is not None:
+            loop.close()
+
+
+def _close_workers(workers, errors):
+    """Close every worker state of a list, see `_close_worker()`.
+
+    Ran in its own thread, since the workers' event loops can't be run
+    from a thread already running one. All states are closed even if
+    some fail, their exceptions are added to the `errors` list.
+    """
+
+    while workers:
+        try:
+            _close_worker(workers.pop())
+        except Exception as err:
+            errors.append(err)
+
+
+def _split_items(iterable, chunksize):
+    """Lazily split iterable sequence of items into contiguous subsequences.
+
+    Neighbour items stay together, so that a sequence sorted by host keeps
+    requests to the same host on the same session and its connections.
+    Items are read from `iterable` only as subsequences are requested,
+    without copying the whole sequence first.
+
+    Args:
+        iterable:  Iterable sequence of element, like a list or generator.
+        chunksize (int): Number of items per subsequence, the last one
+            may have less.
+
+    Returns:
+        (generator): Tuple for each subsequence.
 
     Examples:
-    >>> list(_split_items([i for i in range(1, 11)], 3)):
-    [[1, 4, 7, 10], [2, 5, 8], [3, 6, 9]]
+    >>> list(_split_items(range(1, 11), 4))
+    [(1, 2, 3, 4), (5, 6, 7, 8), (9, 10)]
+    """
+
+    iterator = iter(iterable)
+    chunk    = tuple(itertools.islice(iterator, chunksize))
+
+    while chunk:
+        yield chunk
+        chunk = tuple(itertools.islice(iterator, chunksize))
+
+
+def _chunk_items(iterable, chunksize, processes):
+    """Split iterable sequence of items into subsequences of chunksize items.
+
+    Args:
+        iterable:  Iterable sequence of element, like a list or tuple.
+        chunksize (int): Number of items per subsequence. If `None`,
+            `len(iterable) // (processes * 4)` bounded between 1 and 64,
+            `iterable` must then have a length.
+        processes (int): Number of processes the subsequences are for.
+
+    Returns:
+        (generator): See `_split_items()`.
     """
 
-    if not isinstance(iterable, (list, tuple)):
-        iterable = tuple(iterable)
+    if chunksize is None:
+        chunksize = max(1, min(64, len(iterable) // (processes * 4)))
+
+    return _split_items(iterable, chunksize)
+
+
+def _event_loop_running():
+    """Return whether the current thread is running an asyncio event loop."""
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+
+    return True
+
+
+async def _gather(coroutines):
+    return await asyncio.gather(*coroutines)
+
+
+def _run_coroutines(worker, coroutines):
+    """Run coroutines concurrently in the worker's event loop.
+
+    The loop is created on first use and kept for the worker's lifetime,
+    since asynchronous clients like `httpx.AsyncClient` bind their
+    connections to the loop they were first used in.
+    """
+
+    loop = worker.get("loop")
+
+    if loop is None:
+        loop = worker["loop"] = asyncio.new_event_loop()
+
+    return loop.run_until_complete(_gather(coroutines))
+
+
+def _map_wrap_func(func, extractor, subsequence, worker=None):
+    worker  = worker or _WORKER.__dict__
+    session = worker["session"]
+
+    if inspect.iscoroutinefunction(func):
+        results = _run_coroutines(
+            worker, (func(item, session) for item in subsequence)
+        )
+    else:
+        results = [func(item, session) for item in subsequence]
+
+    return results if extractor is None else [extractor(r) for r in results]
+
 
-    for i in range(split_in):
-        yield iterable[i::split_in]
+def _starmap_wrap_func(func, extractor, subsequence, worker=None):
+    worker  = worker or _WORKER.__dict__
+    session = worker["session"]
+
+    if inspect.iscoroutinefunction(func):
+        results = _run_coroutines(
+            worker, (func(*item, session) for item in subsequence)
+        )
+    else:
+        results = [func(*item, session) for item in subsequence]
+
+    return results if extractor is None else [extractor(r) for r in results]
 
 
 def _flatten_or_not(flatten, iterable):
-    return [i for sub in iterable for i in sub] if flatten else iterable
+    if flatten:
+        return itertools.chain.from_iterable(iterable)
+
+    return iter(iterable)
 
 
 class RequestsPool(object):
     """Multiprocessing pool providing a unique request session per process.
 
-    Every process started by the `map()` or `starmap()` methods will have a
-    unique and constant request session assigned;
-    this allows safe requests multiprocessing usage.
+    Every thread or process started by the `map()` or `starmap()` methods
+    will have a unique and constant request session assigned;
+    this allows safe requests multithreading/multiprocessing usage.
 
     The session will be passed as additional argument to the
     `map()`/`starmap()` target function.
 
     Attributes:
-        processes (int): Number of processes to run in parallel, defaults to
-            `os.cpu_count()`.
+        processes (int): Number of threads or processes to run in parallel.
+            Defaults to the number of CPUs usable by the current process
+            for the `"process"` backend, and to that number plus 4 (at most
+            32) for the `"thread"` backend, like
+            `concurrent.futures.ThreadPoolExecutor`, since threads mostly
+            wait on the network.
+
+        backend (str): `"thread"` to run workers as threads of the current
+            process (the default), or `"process"` to run them as separate
+            processes. Threads are best for network-bound work, since
+            requests releases the GIL while waiting on sockets and nothing
+            has to be pickled between workers and the main process.
+            Processes are only worth it when the target function also does
+            CPU-heavy work, like parsing large responses.
+            Process workers are started with the `"forkserver"` method on
+            Linux and `"spawn"` elsewhere: the target function and
+            `special_func` must be importable (defined at module level), and
+            the main script must be guarded by `if __name__ == "__main__":`.
 
         special_func (function): Function that will be run to get a specific
-            object for each process, defaults to `requests.Session`.
+            object for each process, defaults to a `requests.Session` with
+            keep-alive connection pools of `pool_maxsize` and retries.
+            Other clients can be used, like `httpx.Client` or
+            `httpx.AsyncClient`. With `http2=True`, an `httpx.AsyncClient`
+            and a coroutine target function multiplex the requests of
+            a chunk over a single connection to HTTP/2 hosts; synchronous
+            clients still send one request at a time per worker.
 
         special_args (tuple): Positional arguments passed to the
             `special_func`, defaults to `()` (no args).
@@ -77,49 +315,202 @@ class RequestsPool(object):
         special_kwargs (dict): Keyword arguments passed to the
             `special_func`, defaults to `{}` (no kwargs).
 
+        pool_maxsize (int): Maximum number of connections per host kept
+            alive by the default session, defaults to `32`.
+            Unused if `special_func` is passed.
+
+        inline_threshold (int): `map()`/`starmap()` calls with a sized
+            iterable of at most this many items are run directly in the
+            calling thread, with its own special object, instead of being
+            sent to the workers. Defaults to `1`.
+            `initializer` is not run for these calls, since it is meant for
+            workers and would otherwise run in the caller.
+            Coroutine functions called from a running event loop are always
+            sent to the workers.
+            The workers are only started on the first call that needs them,
+            so a pool only getting small iterables never starts any.
+
     Undocumented additional `multiprocessing.Pool` attributes:
 
         initializer (function): Function ran at the start of a
-            `multiprocessing.Pool` worker. Defaults to `None`.
+            pool worker, after its special object was created.
+            Defaults to `None`.
 
         initargs (tuple): Arguments passed to `initializer`, defaults to `()`.
 
         maxtasksperchild (int): Maximum number of tasks per process?
-            Defaults to `None`.
+            Defaults to `None`. Only supported by the `"process"` backend.
     """
     def __init__(self, processes=None,
                  special_func=None, special_args=None, special_kwargs=None,
-                 initializer=None, initargs=(), maxtasksperchild=None):
-        self.processes      = processes      or os.cpu_count()
-        self.special_func   = special_func   or requests.Session
+                 initializer=None, initargs=(), maxtasksperchild=None,
+                 pool_maxsize=32, backend="thread", inline_threshold=1):
+        if backend not in ("thread", "process"):
+            raise ValueError(
+                "backend must be 'thread' or 'process', not %r" % backend
+            )
+
+        if backend == "thread" and maxtasksperchild is not None:
+            raise ValueError(
+                "maxtasksperchild is only supported by the 'process' backend"
+            )
+
+        self.processes      = processes      or (
+            min(32, _cpu_count() + 4) if backend == "thread" else _cpu_count()
+        )
+        self.backend        = backend
+        self.pool_maxsize   = pool_maxsize
+        self.special_func   = special_func   or functools.partial(
+            _new_session, pool_maxsize
+        )
         self.special_args   = special_args   or ()
         self.special_kwargs = special_kwargs or {}
-        self.pool           = multiprocessing.Pool(processes, initializer,
-                                                   initargs, maxtasksperchild)
+
+        self.initializer      = initializer
+        self.initargs         = initargs
+        self.maxtasksperchild = maxtasksperchild
+        self.inline_threshold = inline_threshold
+
+        self._pool      = None
+        self._pool_lock = threading.Lock()
+        self._closed    = False
+        self._inline    = threading.local()
+        self._workers   = []
+
+    @property
+    def pool(self):
+        """Thread or process pool, started on first access."""
+        if self._pool is None:
+            with self._pool_lock:
+                if self._closed:
+                    raise ValueError("RequestsPool is closed")
+
+                if self._pool is None:
+                    self._pool = self._new_pool()
+
+        return self._pool
+
+    def _new_pool(self):
+        init_args = (self.special_func, self.special_args, self.special_kwargs,
+                     self.initializer, self.initargs)
+
+        if self.backend == "thread":
+            return multiprocessing.pool.ThreadPool(
+                self.processes, _worker_init, init_args + (self._workers,)
+            )
+
+        # Forking a server once and workers from it is much cheaper than
+        # spawning fresh interpreters, without inheriting the parent's
+        # whole memory like plain fork.
+        context = multiprocessing.get_context(
+            "forkserver" if sys.platform == "linux" else "spawn"
+        )
+        return context.Pool(
+            self.processes, _worker_init, init_args, self.maxtasksperchild
+        )
 
     def __enter__(self):
         return self
 
     def __exit__(self, type_, value, traceback):
-        self.pool.close()
-
-    def __getstate__(self):
-        """Remove self.pool when pickling to avoid multiprocessing errors."""
-        self_dict = self.__dict__.copy()
-        del self_dict['pool']
-        return self_dict
-
-    def _map_wrap_func(self, func, subsequence):
-        special = self.special_func(*self.special_args, **self.special_kwargs)
-        return [func(item, special) for item in subsequence]
-
-    def _starmap_wrap_func(self, func, subsequence):
-        special = self.special_func(*self.special_args, **self.special_kwargs)
-        return [func(*item, special) for item in subsequence]
-
-    def map(self, func, iterable, chunksize=None, flatten=True):
+        with self._pool_lock:
+            self._closed = True
+
+        self._inline = threading.local()
+
+        if self._pool is not None:
+            if type_ is None:
+                self._pool.close()
+            else:
+                self._pool.terminate()
+
+            self._pool.join()
+
+        if self._workers:
+            errors = []
+            closer = threading.Thread(
+                target=_close_workers, args=(self._workers, errors)
+            )
+            closer.start()
+            closer.join()
+
+            # Don't hide the exception that made us exit, if any.
+            if errors and type_ is None:
+                raise errors[0]
+
+    def _inline_worker(self):
+        worker = getattr(self._inline, "worker", None)
+
+        if worker is None:
+            worker = self._inline.worker = _new_worker(
+                self.special_func, self.special_args, self.special_kwargs
+            )
+            self._workers.append(worker)
+
+        return worker
+
+    def _imap(self, wrap_func, func, iterable, chunksize, ordered,
+              result_extractor):
+        if self._closed:
+            raise ValueError("RequestsPool is closed")
+
+        if chunksize is not None and chunksize < 1:
+            raise ValueError("chunksize must be at least 1")
+
+        if chunksize is None and not hasattr(iterable, "__len__"):
+            iterable = tuple(iterable)
+
+        # Starting workers and sending them items would cost more than
+        # running so few items directly. Coroutines can't be run from
+        # a thread already running an event loop, leave them to workers.
+        inline = (
+            hasattr(iterable, "__len__") and
+            len(iterable) <= self.inline_threshold and
+            not (inspect.iscoroutinefunction(func) and _event_loop_running())
+        )
+
+        if inline:
+            if not len(iterable):
+                return []
+
+            worker = self._inline_worker()
+            return [wrap_func(func, result_extractor, iterable, worker)]
+
+        imap = self.pool.imap if ordered else self.pool.imap_unordered
+        return imap(
+            functools.partial(wrap_func, func, result_extractor),
+            _chunk_items(iterable, chunksize, self.processes)
+        )
+
+    def map(self, func, iterable, chunksize=None, flatten=True, ordered=True,
+            result_extractor=None):
         """Run _map_wrap_func functions, each with split chunks of iterable.
 
+        Args:
+            func (function): Function to call for every item of iterable,
+                with the item and the worker's session as arguments.
+                If it is a coroutine function (`async def`), all items of
+                a chunk are run concurrently in the worker's event loop.
+            iterable: Iterable sequence of items to process.
+            chunksize (int): Number of items a worker processes per task.
+                Defaults to `len(iterable) // (processes * 4)`, bounded
+                between 1 and 64; workers pick up new chunks as they finish,
+                so slow items don't hold back the other workers.
+            flatten (bool): Return a flat list of results instead of
+                a list of results for each chunk, defaults to `True`.
+            ordered (bool): Return the chunks' results in the order the
+                chunks were sent, defaults to `True`. If `False`, results are
+                returned as soon as a chunk is done, which avoids holding
+                finished results back behind a slow chunk.
+            result_extractor (function): Function called in the worker with
+                each result of `func`, its return value is sent back instead.
+                With the `"process"` backend, results are pickled to go back
+                to the main process: returning e.g.
+                `operator.attrgetter("status_code", "content")` of
+                a `requests.Response` instead of the whole object (cookie jar,
+                request, connection info...) makes this much cheaper.
+                Defaults to `None` (results are returned as is).
+
         Example:
             Get multiple pages in parallel, here two at a time:
 
@@ -133,18 +524,17 @@ class RequestsPool(object):
             ...
             [<Response [200]>, <Response [200]>, <Response [200]>]
         """
-        return _flatten_or_not(flatten, self.pool.starmap(
-            self._map_wrap_func,
-            itertools.product((func,), _split_items(iterable, self.processes)),
-            chunksize
+        return list(self.imap(
+            func, iterable, chunksize, flatten, ordered, result_extractor
         ))
 
-    def starmap(self, func, iterable, chunksize=None, flatten=True):
+    def starmap(self, func, iterable, chunksize=None, flatten=True,
+                ordered=True, result_extractor=None):
         """Same as map(), but run _map_starmap_func instead.
 
         Example:
             Get three pages in parallel, pass a same timeout parameter
-            to all target function calls, get each processes's results in their
+            to all target function calls, get each chunk's results in their
             own sublist:
 
             >>> from itertools import product
@@ -161,8 +551,37 @@ class RequestsPool(object):
             ...
             [[<Response [200]>], [<Response [200]>], [<Response [200]>]]
         """
-        return _flatten_or_not(flatten, self.pool.starmap(
-            self._starmap_wrap_func,
-            itertools.product((func,), _split_items(iterable, self.processes)),
-            chunksize
+        return list(self.istarmap(
+            func, iterable, chunksize, flatten, ordered, result_extractor
+        ))
+
+    def imap(self, func, iterable, chunksize=None, flatten=True,
+             ordered=True, result_extractor=None):
+        """Same as map(), but return an iterator over the results.
+
+        All chunks are sent to the workers right away, and results can be
+        used as soon as their chunk is done instead of when all are,
+        overlapping their processing with the remaining requests.
+
+        Example:
+            Print each page's status as soon as it is received:
+
+            >>> with requestspool.RequestsPool(2) as rp:
+            ...     for response in rp.imap(get_url, URLS, ordered=False):
+            ...         print(response.url, response.status_code)
+        """
+        return _flatten_or_not(flatten, self._imap(
+            _map_wrap_func, func, iterable, chunksize, ordered,
+            result_extractor
+        ))
+
+    def istarmap(self, func, iterable, chunksize=None, flatten=True,
+                 ordered=True, result_extractor=None):
+        """Same as starmap(), but return an iterator over the results.
+
+        See `imap()`.
+        """
+        return _flatten_or_not(flatten, self._imap(
+            _starmap_wrap_func, func, iterable, chunksize, ordered,
+            result_extractor
         ))
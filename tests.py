@@ -1,6 +1,10 @@
 #!/bin/python3
 """requestspool simple tests"""
 
+import asyncio
+import operator
+import threading
+import time
 from itertools import product
 from pprint import pprint
 
@@ -9,28 +13,184 @@ from requestspool import RequestsPool
 URLS = ("https://pypi.org/", "https://git.io", "https://gentoo.org")
 
 
-print("map() 2 processes test:")
-
+# Sessions and responses are returned only to inspect them here: with the
+# process backend, both are pickled to be sent back from the workers,
+# which real code should avoid.
 def get_url(url, session):
     return session, session.get(url)
 
-with RequestsPool(2) as rp:
-    RESULTS = rp.map(get_url, URLS, flatten=False)
-    pprint(RESULTS)
 
-# Ensure every process had their own unique session.
-SESSIONS = (RESULTS[proc][0] for proc in range(len(RESULTS)))
-assert len(set(SESSIONS)) == 2
+def get_url_timeout(url, timeout, session):
+    return session, session.get(url, timeout=timeout)
 
 
-print("\nstarmap() 3 processes test:")
+class DummyAsyncClient(object):
+    """Stand-in for an asynchronous client like httpx.AsyncClient."""
 
-def get_url_timeout(url, timeout, session):
-    return session, session.get(url, timeout=timeout)
+    INSTANCES = []
+
+    def __init__(self):
+        self.closed = False
+        DummyAsyncClient.INSTANCES.append(self)
+
+    async def aclose(self):
+        self.closed = True
+
+
+async def sleep_echo(item, _client):
+    # Later items finish first, results must still follow the input order.
+    await asyncio.sleep(0.01 * (10 - item))
+    return item
+
+
+def echo(item, _session):
+    return item
+
+
+def add(first, second, _session):
+    return first + second
+
+
+def session_id(_item, session):
+    # Give other workers time to pick up the next items.
+    time.sleep(0.01)
+    return id(session)
+
+
+def thread_name(_item, _session):
+    return threading.current_thread().name
+
+
+# Threads the initializer ran in, it never appends anything here when
+# it runs in worker processes.
+INIT_THREADS = []
+
+
+def record_init():
+    INIT_THREADS.append(threading.current_thread().name)
+
+
+def double_with_lock(item, _session):
+    # Locks can't be pickled: with the process backend, this result can only
+    # come back if result_extractor already dropped the lock in the worker.
+    return item * 2, threading.Lock()
+
+
+if __name__ == "__main__":
+    for BACKEND in ("thread", "process"):
+        print("%s backend, coroutine target test:" % BACKEND)
+
+        with RequestsPool(2, special_func=DummyAsyncClient,
+                          backend=BACKEND) as rp:
+            assert rp.map(sleep_echo, range(10), chunksize=5) == \
+                   list(range(10))
+
+        if BACKEND == "thread":
+            # Each worker's client was closed in its event loop on exit.
+            assert DummyAsyncClient.INSTANCES
+            assert all(c.closed for c in DummyAsyncClient.INSTANCES)
+
+        print("%s backend, chunksize test:" % BACKEND)
+
+        with RequestsPool(2, backend=BACKEND) as rp:
+            # Defaults to len(iterable) // (processes * 4), within [1, 64].
+            for length, size in ((5, 1), (100, 12), (10000, 64)):
+                CHUNKS = rp.map(echo, range(length), flatten=False)
+                assert [len(c) for c in CHUNKS[:-1]] == \
+                       [size] * (len(CHUNKS) - 1)
+
+            for chunksize, items in product((0, -1), ([1], range(10))):
+                try:
+                    rp.map(echo, items, chunksize=chunksize)
+                except ValueError:
+                    pass
+                else:
+                    raise AssertionError("chunksize=%d didn't raise "
+                                         "ValueError" % chunksize)
+
+        print("%s backend, inline calls test:" % BACKEND)
+
+        del INIT_THREADS[:]
+        rp = RequestsPool(2, backend=BACKEND, initializer=record_init)
+
+        with rp:
+            # A single item runs in the caller without starting workers,
+            # and without running the workers' initializer.
+            assert rp.map(thread_name, ["item"]) == ["MainThread"]
+            assert rp._pool is None
+            assert not INIT_THREADS
+
+            rp.map(thread_name, range(10))
+            assert rp._pool is not None
+
+        if BACKEND == "thread":
+            assert INIT_THREADS and "MainThread" not in INIT_THREADS
+        else:
+            assert not INIT_THREADS
+
+        try:
+            rp.map(thread_name, ["item"])
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("map() after exit didn't raise ValueError")
+
+        print("%s backend, imap()/istarmap() test:" % BACKEND)
+
+        with RequestsPool(3, backend=BACKEND) as rp:
+            assert list(rp.imap(echo, range(100), chunksize=7)) == \
+                   list(range(100))
+
+            assert sorted(rp.imap(echo, range(100), chunksize=7,
+                                  ordered=False)) == list(range(100))
+
+            assert list(rp.istarmap(add, zip(range(10), range(10)),
+                                    chunksize=3)) == \
+                   [i * 2 for i in range(10)]
+
+            # One sublist per chunk, with items in contiguous chunks.
+            assert rp.map(echo, range(10), chunksize=4, flatten=False) == \
+                   [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+
+            assert rp.map(echo, []) == []
+            assert list(rp.imap(echo, [], flatten=False)) == []
+            assert list(rp.istarmap(add, iter(()))) == []
+
+        print("%s backend, result_extractor test:" % BACKEND)
+
+        with RequestsPool(2, backend=BACKEND) as rp:
+            assert rp.map(double_with_lock, range(10),
+                          result_extractor=operator.itemgetter(0)) == \
+                   [i * 2 for i in range(10)]
+
+        print()
+
+    print("thread backend, unique session per worker test:")
+
+    # Process workers' sessions come back as pickled copies with new ids,
+    # only the thread backend can compare them.
+    with RequestsPool(4) as rp:
+        assert len(set(rp.map(session_id, range(40), chunksize=1))) == 4
+
+    print()
+
+    for BACKEND in ("thread", "process"):
+        print("%s backend, map() 2 workers test:" % BACKEND)
+
+        with RequestsPool(2, backend=BACKEND) as rp:
+            RESULTS = rp.map(get_url, URLS, chunksize=2, flatten=False)
+            pprint(RESULTS)
+
+        # Ensure there is one sublist per chunk.
+        assert len(RESULTS) == 2
+
+
+        print("\n%s backend, starmap() 3 workers test:" % BACKEND)
 
-with RequestsPool(3) as rp:
-    RESULTS = rp.starmap(get_url_timeout, product(URLS, (6,)), flatten=False)
-    pprint(RESULTS)
+        with RequestsPool(3, backend=BACKEND) as rp:
+            RESULTS = rp.starmap(get_url_timeout, product(URLS, (6,)),
+                                 flatten=False)
+            pprint(RESULTS)
 
-SESSIONS = (RESULTS[proc][0] for proc in range(len(RESULTS)))
-assert len(set(SESSIONS)) == 3
+        assert len(RESULTS) == 3
+        print()